@@ -17,7 +17,9 @@ from contextualized.dags.graph_utils import (
     dag_pred,
     dag_pred_np,
     project_to_dag_torch,
+    project_to_dags_torch,
     is_dag,
+    is_dags,
     trim_params,
 )
 
@@ -6,6 +6,7 @@ import pytorch_lightning as pl
 from contextualized.functions import identity_link
 from contextualized.dags.graph_utils import (
     project_to_dag_torch,
+    project_to_dags_torch,
     trim_params,
     dag_pred,
     dag_pred_with_factors,
@@ -380,7 +381,7 @@ class NOTMAD(pl.LightningModule):
             w_preds = self._project_factor_graph_to_var(w_preds)
         if kwargs.get("project_to_dag", False):
             try:
-                w_preds = np.array([project_to_dag_torch(w)[0] for w in w_preds])
+                w_preds = project_to_dags_torch(w_preds)
             except:
                 print("Error, couldn't project to dag. Returning normal predictions.")
         return trim_params(w_preds, thresh=kwargs.get("threshold", 0.0))